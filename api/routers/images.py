@@ -1,14 +1,16 @@
-﻿import uuid
+﻿import os
+import uuid
 
-import exifread
-from fastapi import APIRouter, HTTPException
-from sqlalchemy import select
+import anyio
+import anyio.to_thread
+from fastapi import APIRouter, HTTPException, Query, Request, Response
+from sqlalchemy import select, text
 from starlette import status
-from starlette.responses import FileResponse
+from starlette.responses import FileResponse, StreamingResponse
 
 from db import DbSessionDependency
 from db.models import ImageModel
-from tus_utils import get_image_path, get_image_metadata
+from tus_utils import get_image_path_and_media_type, generate_query_embeddings, quantize_embeddings
 
 images_router = APIRouter(
     prefix="/api/v1/images",
@@ -16,50 +18,161 @@ images_router = APIRouter(
     responses={status.HTTP_404_NOT_FOUND: {"message": "Not found"}},
 )
 
+# images are addressed by immutable UUID, so clients/CDNs can cache them forever
+_IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
 
-@images_router.get("/", response_model=list[ImageModel], status_code=status.HTTP_200_OK)
-def get_images(db_session: DbSessionDependency):
-    images = db_session.scalars(select(ImageModel)).all()
-    return images
+
+class MsgpackResponse(Response):
+    """MessagePack body for bulk consumers: smaller than JSON and keeps binary fields raw."""
+
+    media_type = "application/x-msgpack"
+
+    def render(self, content) -> bytes:
+        import msgpack
+
+        return msgpack.packb(content, use_bin_type=True)
+
+
+def _check_etag(request: Request, etag: str | None) -> tuple[dict[str, str], bool]:
+    """Build caching headers for an image and report whether If-None-Match hit."""
+    if not etag:
+        # the etag (with EXIF and embeddings) lands via a background task shortly
+        # after upload; an immutable header in that window would cache the
+        # incomplete response for a year, so have caches revalidate until then
+        return {"Cache-Control": "no-cache"}, False
+    quoted = f'"{etag}"'
+    headers = {"Cache-Control": _IMMUTABLE_CACHE_CONTROL, "ETag": quoted}
+    return headers, request.headers.get("if-none-match") == quoted
+
+
+@images_router.get("/", status_code=status.HTTP_200_OK)
+async def get_images(db_session: DbSessionDependency, limit: int = Query(50, ge=1, le=200),
+                     cursor: uuid.UUID | None = None):
+    # keyset pagination (id > cursor) avoids the O(offset) scan of OFFSET paging, and
+    # selecting only the list columns keeps the 2 KB embeddings out of the payload
+    stmt = (
+        select(ImageModel.id, ImageModel.file_name, ImageModel.created_at, ImageModel.tags)
+        .order_by(ImageModel.id)
+        .limit(limit)
+    )
+    if cursor is not None:
+        stmt = stmt.where(ImageModel.id > cursor)
+    images = [dict(row) for row in (await db_session.execute(stmt)).mappings()]
+    next_cursor = images[-1]["id"] if images and len(images) == limit else None
+    return {"items": images, "next_cursor": next_cursor}
 
 
 @images_router.get("/{image_id}", response_class=FileResponse, status_code=status.HTTP_200_OK)
-def get_image(image_id: uuid.UUID):
+async def get_image(image_id: uuid.UUID, request: Request, db_session: DbSessionDependency):
+    try:
+        # the sidecar read is blocking disk I/O, so run it off the event loop
+        image_path, media_type, filename = await anyio.to_thread.run_sync(get_image_path_and_media_type, image_id)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    image = await db_session.get(ImageModel, image_id)
+    headers, not_modified = _check_etag(request, image.etag if image is not None else None)
+    if not_modified:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    # FileResponse streams the file with sendfile/chunked reads instead of
+    # buffering the whole image in memory
+    return FileResponse(image_path, media_type=media_type, filename=filename, headers=headers)
+
+
+async def _iter_file(image_path, chunk_size: int = 1 << 20):
+    async with await anyio.open_file(image_path, "rb") as f:
+        while chunk := await f.read(chunk_size):
+            yield chunk
+
+
+@images_router.get("/{image_id}/stream", response_class=StreamingResponse, status_code=status.HTTP_200_OK)
+async def get_image_stream(image_id: uuid.UUID, request: Request, db_session: DbSessionDependency):
+    """Chunked-read variant of get_image for very large originals (raw/TIFF).
+
+    FileResponse relies on sendfile passthrough; behind ASGI proxies that buffer it,
+    explicit 1 MiB chunks give bounded, predictable per-connection memory.
+    """
     try:
-        metadata = get_image_metadata(image_id)
-        media_type = metadata.metadata.get("filetype", "image/jpeg")
+        image_path, media_type, _ = await anyio.to_thread.run_sync(get_image_path_and_media_type, image_id)
     except FileNotFoundError as e:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
-    image_path = get_image_path(image_id)
-    return FileResponse(image_path, media_type=media_type)
+    image = await db_session.get(ImageModel, image_id)
+    headers, not_modified = _check_etag(request, image.etag if image is not None else None)
+    if not_modified:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    # an explicit Content-Length spares the client chunked transfer encoding
+    headers["Content-Length"] = str(os.stat(image_path).st_size)
+    return StreamingResponse(_iter_file(image_path), media_type=media_type, headers=headers)
 
 
 @images_router.get("/{image_id}/exif", response_model=dict, status_code=status.HTTP_200_OK)
-def get_image_exif(image_id: uuid.UUID):
-    file_path = get_image_path(image_id)
-    with open(file_path, "rb") as f:
-        # per docs: expects an open file object
-        # details=False to avoid loading the entire file
-        exif_tags = exifread.process_file(f, details=False)
-    structured_exif = {}
-    for tag, value in exif_tags.items():
-        first, second = tag.split(" ")
-        real_value = value.values
-        structured_exif.setdefault(first, {})[second] = real_value
-    return structured_exif
-
-
-@images_router.get("/{image_id}/data", response_model=ImageModel, status_code=status.HTTP_200_OK)
-def get_image_data(image_id: uuid.UUID, db_session: DbSessionDependency):
-    image = db_session.scalars(select(ImageModel).where(ImageModel.id == image_id)).one_or_none()
+async def get_image_exif(image_id: uuid.UUID, request: Request, response: Response, db_session: DbSessionDependency):
+    # EXIF is parsed once at upload time (see tus_on_upload_complete) and cached
+    # in the exif_data JSONB column; serving from the DB avoids re-reading the file
+    image = await db_session.get(ImageModel, image_id)
+    if image is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Image not found in database")
+    headers, not_modified = _check_etag(request, image.etag)
+    # this URL serves msgpack or JSON depending on Accept; without Vary a shared
+    # cache would replay whichever representation it stored first to everyone
+    headers["Vary"] = "Accept"
+    if not_modified:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    if MsgpackResponse.media_type in request.headers.get("accept", ""):
+        return MsgpackResponse(image.exif_data or {}, headers=headers)
+    response.headers.update(headers)
+    return image.exif_data or {}
+
+
+# no response_model: skipping FastAPI's per-field re-validation saves CPU on the
+# hot read path, but that also means nothing coerces the vector columns — HALFVEC
+# loads as a numpy array the JSON encoder rejects, so build the payload by hand
+@images_router.get("/{image_id}/data", status_code=status.HTTP_200_OK)
+async def get_image_data(image_id: uuid.UUID, db_session: DbSessionDependency):
+    # Session.get is the fast path for PK lookups (identity map + cached compiled query)
+    image = await db_session.get(ImageModel, image_id)
     if image is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Image not found in database")
-    return image
+    return {
+        "id": image.id,
+        "file_name": image.file_name,
+        "caption": image.caption,
+        "etag": image.etag,
+        "exif_data": image.exif_data,
+        "embeddings": image.embeddings.tolist() if image.embeddings is not None else None,
+        "created_at": image.created_at,
+        "tags": image.tags,
+    }
 
 
-@images_router.get("/{image_id}/search", response_model=list[ImageModel], status_code=status.HTTP_200_OK)
-def search_images(image_id: uuid.UUID, query: str | None, db_session: DbSessionDependency):
-    # TODO: search by embeddings
-    # when query is None, return all images
-    # otherwise, do a cosine similarity search
-    raise NotImplementedError("Search by embeddings is not implemented yet")
+@images_router.get("/{image_id}/search", status_code=status.HTTP_200_OK)
+async def search_images(image_id: uuid.UUID, query: str | None, db_session: DbSessionDependency,
+                        limit: int = Query(10, ge=1, le=100)):
+    # select only the listing columns (as get_images does): the vector columns come
+    # back as numpy arrays, which FastAPI's JSON encoder rejects with a 500
+    columns = (ImageModel.id, ImageModel.file_name, ImageModel.created_at, ImageModel.tags)
+    # when query is None, return the first page of images (bounded, like get_images)
+    if query is None:
+        stmt = select(*columns).order_by(ImageModel.id).limit(limit)
+        return [dict(row) for row in (await db_session.execute(stmt)).mappings()]
+    # the model encode is CPU/GPU-bound, keep it off the event loop
+    query_embeddings = await anyio.to_thread.run_sync(generate_query_embeddings, query)
+    # first stage: Hamming distance over the sign bits scans 16x less data per row
+    # than the halfvec index; overfetch candidates, then rerank with full cosine
+    candidate_count = limit * 10
+    candidates = (
+        select(ImageModel.id)
+        .where(ImageModel.embeddings_bits.is_not(None))
+        .order_by(ImageModel.embeddings_bits.hamming_distance(quantize_embeddings(query_embeddings)))
+        .limit(candidate_count)
+        .scalar_subquery()
+    )
+    # an HNSW scan yields at most ef_search rows, so it must cover the overfetch
+    # (SET takes no bind parameters; candidate_count is a validated int)
+    await db_session.execute(text(f"SET LOCAL hnsw.ef_search = {candidate_count}"))
+    stmt = (
+        select(*columns)
+        .where(ImageModel.id.in_(candidates))
+        .order_by(ImageModel.embeddings.cosine_distance(query_embeddings))
+        .limit(limit)
+    )
+    return [dict(row) for row in (await db_session.execute(stmt)).mappings()]
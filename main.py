@@ -1,20 +1,39 @@
-﻿import logging
+﻿import asyncio
+import logging
+import logging.handlers
+import queue
+import re
 import sys
 from contextlib import asynccontextmanager
 
 import uvicorn
-from fastapi import FastAPI, Response, Request
+from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, RedirectResponse
 from starlette import status
 from starlette.staticfiles import StaticFiles
 from tusserver.tus import create_api_router
 
 from api.routers.images import images_router
 from db import sessionmanager
-from tus_utils import tus_naming_function, FILES_DIR, tus_on_upload_complete
+from settings import settings
+from tus_utils import tus_naming_function, FILES_DIR, embedding_batch_worker, naming_batch_worker, \
+    tus_on_upload_complete
 
-# TODO: settings class
-logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+
+def _setup_logging() -> logging.handlers.QueueListener:
+    """Route log records through a queue so the hot path never blocks on a stdout flush."""
+    log_queue = queue.Queue(-1)
+    root_logger = logging.getLogger()
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    # DEBUG formats + flushes per tus chunk; keep that to development only
+    root_logger.setLevel(logging.DEBUG if settings.env == "dev" else logging.INFO)
+    listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler(sys.stdout))
+    listener.start()
+    return listener
+
+
+_log_listener = _setup_logging()
 
 
 @asynccontextmanager
@@ -23,30 +42,69 @@ async def lifespan(app: FastAPI):
     Function that handles startup and shutdown events.
     To understand more, read https://fastapi.tiangolo.com/advanced/events/
     """
+    await sessionmanager.init()
+    logging.info("Database initialized")
+    # batch concurrent upload-create INSERTs and CLIP encodes into single calls
+    naming_task = asyncio.create_task(naming_batch_worker())
+    embedding_task = asyncio.create_task(embedding_batch_worker())
     yield
+    naming_task.cancel()
+    embedding_task.cancel()
     if sessionmanager._engine is not None:
         # Close the DB connection
-        sessionmanager.close()
+        await sessionmanager.close()
+
+
+# orjson is a C JSON encoder several times faster than stdlib json and handles
+# datetime/UUID natively
+app = FastAPI(lifespan=lifespan, title="pypix", docs_url="/api/docs", default_response_class=ORJSONResponse)
+
+# content-hashed filenames (e.g. app.3f2a9c1b.js) never change, so browsers can keep them forever
+_HASHED_ASSET_RE = re.compile(r"\.[0-9a-f]{8,}\.")
 
 
-app = FastAPI(lifespan=lifespan, title="pypix", docs_url="/api/docs")
+class CachedStaticFiles(StaticFiles):
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        if _HASHED_ASSET_RE.search(str(full_path)):
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
 
-# TODO: remove in production
-app.mount("/static", StaticFiles(directory="static"), name="static")
+
+# the upload form is a dev convenience; don't serve (or stat) it in production.
+# the root redirect targets the mount, so it only exists when the mount does —
+# in production it would be a guaranteed 404
+if settings.env == "dev":
+    app.mount("/static", CachedStaticFiles(directory="static"), name="static")
+
+    # precomputed: the mount path is fixed, so no per-request url_for reverse lookup
+    UPPY_URL = "/static/uppy.html"
+
+    @app.get("/")
+    async def root() -> RedirectResponse:
+        # async skips the threadpool hop a sync handler would pay for a bare redirect
+        return RedirectResponse(UPPY_URL, status_code=status.HTTP_307_TEMPORARY_REDIRECT)
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
+    # concrete origins come from the environment in production (comma-separated)
+    allow_origins=list(settings.cors_origins),
+    # wildcard + credentials is non-compliant and forces the middleware to echo the
+    # request origin on every response; with credentials off it emits a static header
+    allow_credentials="*" not in settings.cors_origins,
     allow_methods=["*"],
     allow_headers=["*"],
+    # cache preflights for a day so tus upload sessions don't re-OPTIONS every chunk
+    max_age=86400,
 )
 
-# TODO: on_upload_complete handler for AI processing
 app.include_router(
     create_api_router(
         files_dir=FILES_DIR,
         location="http://127.0.0.1:8000/api/v1/tus/upload",
+        # mints the UUIDv7 file id and queues the row INSERT for the naming
+        # batch worker; without it uploads never get a database record
+        naming_function=tus_naming_function,
         on_upload_complete=tus_on_upload_complete,
     ),
     prefix="/api/v1/tus/upload",
@@ -55,18 +113,23 @@ app.include_router(
 app.include_router(images_router)
 
 
-@app.get("/")
-def root(request: Request):
-    uppy_url = request.url_for("static", path="uppy.html")
-    return Response(status_code=status.HTTP_307_TEMPORARY_REDIRECT, headers={"Location": str(uppy_url)})
-
-
 def main():
     logging.info("Starting pypix server")
-    sessionmanager.init()
-    logging.info("Database initialized")
+    # DB setup happens in lifespan() now that sessionmanager is async
     # reload breaks the static upload form
-    uvicorn.run("main:app", host="127.0.0.1", reload=False, port=8000)
+    uvicorn.run("main:app", host="127.0.0.1", reload=False, port=8000,
+                # one process = one core; 2n+1 workers actually use the box. Each worker
+                # builds its own engine at import, so no fds are shared across forks
+                workers=settings.web_concurrency,
+                # pin the C event loop + parser; with defaults uvicorn can fall back to
+                # asyncio + h11. The per-request access log serializes through a lock
+                loop="uvloop", http="httptools", access_log=False,
+                # tus clients fire bursts of short requests per chunk: deepen the accept
+                # backlog, keep connections alive across chunks, and cap concurrency
+                # before the event loop drowns. HTTP/2 multiplexing belongs to a
+                # reverse proxy in front of this server
+                backlog=16384, timeout_keep_alive=75, limit_concurrency=2000,
+                h11_max_incomplete_event_size=4 * 1024 * 1024)
 
 
 if __name__ == "__main__":
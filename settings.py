@@ -0,0 +1,25 @@
+﻿from dataclasses import dataclass
+from os import cpu_count, getenv
+
+from dotenv import load_dotenv, find_dotenv
+
+load_dotenv(find_dotenv())
+
+
+@dataclass(frozen=True, slots=True)
+class Settings:
+    """Environment-derived configuration, resolved once at import.
+
+    Call sites read plain attributes instead of paying an os.environ lookup
+    (plus an int()/split() per use) on every access.
+    """
+
+    env: str = getenv("PYPIX_ENV", "dev")
+    postgresql_password: str = getenv("POSTGRESQL_PASSWORD", "")
+    cors_origins: tuple[str, ...] = tuple(
+        origin.strip() for origin in getenv("PYPIX_CORS_ORIGINS", "*").split(",") if origin.strip()
+    )
+    web_concurrency: int = int(getenv("WEB_CONCURRENCY", cpu_count() * 2 + 1))
+
+
+settings = Settings()